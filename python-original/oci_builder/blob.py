@@ -18,52 +18,151 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import codecs
+import errno
 import hashlib
 import os
 import tempfile
 from contextlib import contextmanager
 
+# Largest chunk handed to a single copy_file_range()/sendfile() call
+COPY_CHUNK_SIZE = 1024**3
+# Buffer size for copies done in userspace. The shutil default of 64 KiB means
+# tens of thousands of Python level reads and writes for a large layer
+COPY_BUFFER_SIZE = 4 * 1024 * 1024
+
+
+def fast_copy(src_fd, dst_fd, length):
+    # Let the kernel copy the data (or reflink it on filesystems that support
+    # it) rather than pulling every byte through Python
+    copied = 0
+    try:
+        while copied < length:
+            count = os.copy_file_range(
+                src_fd, dst_fd, min(length - copied, COPY_CHUNK_SIZE)
+            )
+            if count == 0:
+                break
+            copied += count
+    except OSError as error:
+        if error.errno not in (
+            errno.EXDEV,
+            errno.ENOSYS,
+            errno.EINVAL,
+            errno.EOPNOTSUPP,
+        ):
+            raise
+        try:
+            while copied < length:
+                count = os.sendfile(
+                    dst_fd, src_fd, None, min(length - copied, COPY_CHUNK_SIZE)
+                )
+                if count == 0:
+                    break
+                copied += count
+        except OSError as error:
+            if error.errno not in (errno.ENOSYS, errno.EINVAL):
+                raise
+            # Both calls above advance the file offsets, so carry on from
+            # where they stopped and copy no more than length
+            with open(src_fd, "rb", closefd=False) as src, open(
+                dst_fd, "wb", closefd=False
+            ) as dst:
+                while copied < length:
+                    data = src.read(min(length - copied, COPY_BUFFER_SIZE))
+                    if not data:
+                        break
+                    dst.write(data)
+                    copied += len(data)
+    if copied != length:
+        raise RuntimeError(f"Expected to copy {length} bytes, copied {copied}")
+
+
+class HashingWriter:
+    # Write-only proxy that hashes data as it is written, so the file
+    # never needs to be read back to compute its digest
+    def __init__(self, file):
+        self.file = file
+        self.hash = hashlib.sha256()
+
+    def write(self, data):
+        self.hash.update(data)
+        return self.file.write(data)
+
+    def tell(self):
+        return self.file.tell()
+
+    def flush(self):
+        self.file.flush()
+
 
 class Blob:
-    def __init__(self, global_conf, media_type=None, text=False):
+    def __init__(self, global_conf, media_type=None):
         self.global_conf = global_conf
         self.descriptor = None
         self.media_type = media_type
-        self.text = text
         self.filename = None
 
+    def blob_filename(self, digest):
+        algo, hexdigest = digest.split(":", 1)
+        blob_dir = os.path.join(self.global_conf.output, "blobs", algo)
+        os.makedirs(blob_dir, exist_ok=True)
+        return os.path.join(blob_dir, hexdigest)
+
+    def set_existing(self, filename, digest, size):
+        self.descriptor = {}
+        if self.media_type:
+            self.descriptor["mediaType"] = self.media_type
+        self.descriptor["size"] = size
+        self.descriptor["digest"] = digest
+        self.filename = filename
+
+    def link(self, filename, digest, size):
+        blob_filename = self.blob_filename(digest)
+        try:
+            os.link(filename, blob_filename)
+        except FileExistsError:
+            # Blobs are content addressed, so an existing one is identical
+            pass
+        self.set_existing(blob_filename, digest, size)
+
+    def copy(self, filename, digest, size):
+        # Like link(), the digest is already known so the copy is not hashed
+        blob_filename = self.blob_filename(digest)
+        with open(filename, "rb") as src, tempfile.NamedTemporaryFile(
+            mode="wb", dir=self.global_conf.output, delete=False
+        ) as file:
+            try:
+                fast_copy(src.fileno(), file.fileno(), size)
+            except:  # noqa: E722
+                try:
+                    os.unlink(file.name)
+                except:  # noqa: E722
+                    pass
+                raise
+        os.rename(file.name, blob_filename)
+        self.set_existing(blob_filename, digest, size)
+
     @contextmanager
     def create(self):
         with tempfile.NamedTemporaryFile(
             mode="w+b", dir=self.global_conf.output, delete=False
         ) as file:
             filename = file.name
+            writer = HashingWriter(file)
             try:
-                if self.text:
-                    yield codecs.getwriter("utf-8")(file)
-                else:
-                    yield file
+                yield writer
                 self.descriptor = {}
                 if self.media_type:
                     self.descriptor["mediaType"] = self.media_type
-                file.seek(0, 2)
                 self.descriptor["size"] = file.tell()
-                file.seek(0)
-                file_hash = hashlib.sha256()
-                while True:
-                    data = file.read(16 * 1204)
-                    if len(data) == 0:
-                        break
-                    file_hash.update(data)
-                hexdigest = file_hash.hexdigest()
+                hexdigest = writer.hash.hexdigest()
                 self.descriptor["digest"] = f"sha256:{hexdigest}"
                 os.makedirs(
                     os.path.join(self.global_conf.output, "blobs", "sha256"),
                     exist_ok=True,
                 )
                 self.filename = os.path.join(
-                    self.global_conf.output, "blobs", "sha256", file_hash.hexdigest()
+                    self.global_conf.output, "blobs", "sha256", hexdigest
                 )
                 os.rename(filename, self.filename)
             except:
@@ -24,7 +24,7 @@ from typing import Optional
 
 import yaml
 
-from .image_builder import Compression, build_images
+from .image_builder import Compression, FileChecksum, GzipEngine, build_images
 
 
 @dataclasses.dataclass
@@ -32,6 +32,12 @@ class GlobalConfig:
     compression: Compression
     compression_level: Optional[int]
     output: str
+    compression_threads: Optional[int]
+    tar_index_cache: Optional[str]
+    gzip_engine: GzipEngine
+    file_checksum: FileChecksum
+    # Threads building one image may use, None for one per core
+    threads: Optional[int] = None
 
 
 def main():
@@ -41,8 +47,28 @@ def main():
     if compression_level is None:
         if compression == Compression.gzip:
             compression_level = 5
+    compression_threads = data.get("compression-threads")
+    tar_index_cache = data.get("tar-index-cache")
+    # Anything but the stdlib gzip engine produces different layer digests
+    gzip_engine = data.get("gzip-engine", GzipEngine.gzip)
     if compression not in Compression:
         raise RuntimeError("Compression must be in " + ",".join(Compression))
+    # Checksum stored for files that do not have one in an xattr. blake3 is
+    # faster, but the layers then lack the sha256 checksums that other
+    # builders dedup on
+    file_checksum = data.get("file-checksum", FileChecksum.sha256)
+    if gzip_engine not in GzipEngine:
+        raise RuntimeError("Gzip engine must be in " + ",".join(GzipEngine))
+    if file_checksum not in FileChecksum:
+        raise RuntimeError("File checksum must be in " + ",".join(FileChecksum))
 
-    global_conf = GlobalConfig(compression, compression_level, os.getcwd())
+    global_conf = GlobalConfig(
+        compression,
+        compression_level,
+        os.getcwd(),
+        compression_threads,
+        tar_index_cache,
+        gzip_engine,
+        file_checksum,
+    )
     build_images(global_conf, data.get("images", []), data.get("annotations"))
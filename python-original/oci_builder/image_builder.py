@@ -17,19 +17,49 @@
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
+import dataclasses
 import enum
+import functools
 import gzip
-import hashlib
 import json
 import os
 import shutil
 import tarfile
-import tempfile
 import time
+from concurrent.futures import ProcessPoolExecutor
 from contextlib import ExitStack
 
-from .blob import Blob
-from .layer_builder import create_layer
+from .blob import COPY_BUFFER_SIZE, Blob, HashingWriter
+from .layer_builder import (
+    PAX_HEADER_BLAKE3,
+    PAX_HEADER_SHA256,
+    TAR_INDEX_VERSION,
+    create_layer,
+)
+
+try:
+    import pgzip
+except ImportError:
+    pgzip = None
+
+try:
+    from zlib_ng import gzip_ng
+except ImportError:
+    gzip_ng = None
+
+try:
+    import rapidgzip
+except ImportError:
+    rapidgzip = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Size of the independently compressed members written by pgzip, and of the
+# chunks rapidgzip splits a stream into when decompressing
+GZIP_BLOCK_SIZE = 4 * 1024 * 1024
 
 
 class Compression(enum.StrEnum):
@@ -37,6 +67,17 @@ class Compression(enum.StrEnum):
     disabled = enum.auto()
 
 
+class FileChecksum(enum.StrEnum):
+    sha256 = enum.auto()
+    blake3 = enum.auto()
+
+
+class GzipEngine(enum.StrEnum):
+    gzip = enum.auto()
+    pgzip = enum.auto()
+    zlib_ng = "zlib-ng"
+
+
 def get_gzip_opts():
     epoch = os.environ.get("SOURCE_DATE_EPOCH")
     if epoch is None:
@@ -44,6 +85,68 @@ def get_gzip_opts():
     return {"mtime": int(epoch)}
 
 
+def get_compression_threads(global_conf):
+    # pgzip gives the same output whatever the thread count, so the per image
+    # limit does not change layer digests
+    if global_conf.compression_threads is not None:
+        return global_conf.compression_threads
+    return global_conf.threads
+
+
+def open_gzip_writer(filename, fileobj, global_conf):
+    # Each engine compresses to different bytes, so which one is used is part
+    # of the configuration rather than of what happens to be installed. A
+    # missing engine falls back to the default
+    if global_conf.gzip_engine == GzipEngine.pgzip and pgzip is not None:
+        return pgzip.PgzipFile(
+            filename=filename,
+            fileobj=fileobj,
+            mode="wb",
+            compresslevel=global_conf.compression_level,
+            thread=get_compression_threads(global_conf),
+            blocksize=GZIP_BLOCK_SIZE,
+            **get_gzip_opts(),
+        )
+    if global_conf.gzip_engine == GzipEngine.zlib_ng and gzip_ng is not None:
+        return gzip_ng.GzipNGFile(
+            filename=filename,
+            fileobj=fileobj,
+            mode="wb",
+            compresslevel=global_conf.compression_level,
+            **get_gzip_opts(),
+        )
+    return gzip.GzipFile(
+        filename=filename,
+        fileobj=fileobj,
+        mode="wb",
+        compresslevel=global_conf.compression_level,
+        **get_gzip_opts(),
+    )
+
+
+def open_gzip_reader(fileobj, global_conf):
+    if rapidgzip is not None and global_conf.compression_threads != 1:
+        return rapidgzip.RapidgzipFile(
+            fileobj,
+            parallelization=get_compression_threads(global_conf) or os.cpu_count() or 1,
+            chunk_size=GZIP_BLOCK_SIZE,
+        )
+    return gzip.open(filename=fileobj, mode="rb")
+
+
+def dump_json_bytes(obj, file):
+    # Encode the whole document at once and write it as bytes, so the blob's
+    # hashing writer sees a single write instead of going through a text codec.
+    # Both encoders must give the same bytes, or digests would depend on
+    # whether orjson is installed
+    if orjson is not None:
+        file.write(orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS))
+    else:
+        file.write(
+            json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+        )
+
+
 def extract_oci_image_info(path, index, global_conf):
     with open(os.path.join(path, "index.json"), "r", encoding="utf-8") as index_file:
         indexed_manifest = json.load(index_file)
@@ -76,29 +179,34 @@ def extract_oci_image_info(path, index, global_conf):
             output_blob = Blob(
                 global_conf, media_type="application/vnd.oci.image.layer.v1.tar"
             )
-        with ExitStack() as stack:
-            outp = stack.enter_context(output_blob.create())
-            inp = stack.enter_context(open(origfile, "rb"))
-            if layer["mediaType"].endswith("+gzip"):
-                if global_conf.compression == Compression.gzip:
-                    shutil.copyfileobj(inp, outp)
+        if algo == "sha256" and layer["mediaType"].endswith("+gzip") == (
+            global_conf.compression == Compression.gzip
+        ):
+            # The layer is already stored in the format we want, so reuse the
+            # existing blob and its descriptor instead of copying and hashing it
+            try:
+                output_blob.link(origfile, layer["digest"], layer["size"])
+            except OSError:
+                # Most likely a cross-device link, let the kernel copy it
+                output_blob.copy(origfile, layer["digest"], layer["size"])
+        else:
+            with ExitStack() as stack:
+                outp = stack.enter_context(output_blob.create())
+                inp = stack.enter_context(open(origfile, "rb"))
+                if layer["mediaType"].endswith("+gzip"):
+                    if global_conf.compression == Compression.gzip:
+                        shutil.copyfileobj(inp, outp, length=COPY_BUFFER_SIZE)
+                    else:
+                        gzfile = stack.enter_context(open_gzip_reader(inp, global_conf))
+                        shutil.copyfileobj(gzfile, outp, length=COPY_BUFFER_SIZE)
                 else:
-                    gzfile = stack.enter_context(gzip.open(filename=inp, mode="rb"))
-                    shutil.copyfileobj(gzfile, outp)
-            else:
-                if global_conf.compression == Compression.gzip:
-                    gzfile = stack.enter_context(
-                        gzip.GzipFile(
-                            filename=diff_id,
-                            fileobj=outp,
-                            mode="wb",
-                            compresslevel=global_conf.compression_level,
-                            **get_gzip_opts(),
+                    if global_conf.compression == Compression.gzip:
+                        gzfile = stack.enter_context(
+                            open_gzip_writer(diff_id, outp, global_conf)
                         )
-                    )
-                    shutil.copyfileobj(inp, gzfile)
-                else:
-                    shutil.copyfileobj(inp, outp)
+                        shutil.copyfileobj(inp, gzfile, length=COPY_BUFFER_SIZE)
+                    else:
+                        shutil.copyfileobj(inp, outp, length=COPY_BUFFER_SIZE)
 
         layer_descs.append(output_blob.descriptor)
         layer_files.append(output_blob.filename)
@@ -107,54 +215,63 @@ def extract_oci_image_info(path, index, global_conf):
 
 
 def build_layer(upper, lowers, global_conf):
-    new_layer_descs = []
+    if global_conf.compression == Compression.gzip:
+        layer_blob = Blob(
+            global_conf, media_type="application/vnd.oci.image.layer.v1.tar+gzip"
+        )
+    else:
+        layer_blob = Blob(
+            global_conf, media_type="application/vnd.oci.image.layer.v1.tar"
+        )
 
     with ExitStack() as stack:
-        # By default tempfile will place it in /tmp, but since its an image we should
-        # use /var/tmp to avoid writing all of it into ram
-        os.makedirs("/var/tmp", mode=0o1777, exist_ok=True)
-        tfile = stack.enter_context(tempfile.TemporaryFile(mode="w+b", dir="/var/tmp"))
-        tar = stack.enter_context(tarfile.open(fileobj=tfile, mode="w:"))
         lower_tars = []
+        lower_indexes = []
         read_mode = "r:gz" if global_conf.compression == Compression.gzip else "r:"
         for lower in lowers:
             lower_tars.append(
                 stack.enter_context(tarfile.open(name=lower, mode=read_mode))
             )
-        create_layer(tar, upper, lower_tars)
-        tfile.seek(0)
-        tar_hash = hashlib.sha256()
-        while True:
-            data = tfile.read(16 * 1024)
-            if len(data) == 0:
-                break
-            tar_hash.update(data)
-        tfile.seek(0)
+            if global_conf.tar_index_cache:
+                # Lowers are blobs, so their file name is their digest
+                index_name = f"{os.path.basename(lower)}.v{TAR_INDEX_VERSION}.json"
+                lower_indexes.append(
+                    os.path.join(global_conf.tar_index_cache, index_name)
+                )
+            else:
+                lower_indexes.append(None)
+        # The tar is streamed straight into the blob, hashing the uncompressed
+        # data on the way for the diff_id
+        layer_file = stack.enter_context(layer_blob.create())
         if global_conf.compression == Compression.gzip:
-            targz_blob = Blob(
-                global_conf, media_type="application/vnd.oci.image.layer.v1.tar+gzip"
+            gzip_file = stack.enter_context(
+                open_gzip_writer("", layer_file, global_conf)
             )
-            with targz_blob.create() as gzipfile:
-                with gzip.GzipFile(
-                    filename=tar_hash.hexdigest(),
-                    fileobj=gzipfile,
-                    mode="wb",
-                    compresslevel=global_conf.compression_level,
-                    **get_gzip_opts(),
-                ) as gzip_file:
-                    shutil.copyfileobj(tfile, gzip_file)
-            new_layer_descs.append(targz_blob.descriptor)
+            tar_writer = HashingWriter(gzip_file)
         else:
-            copied_blob = Blob(
-                global_conf, media_type="application/vnd.oci.image.layer.v1.tar"
+            tar_writer = layer_file
+        with tarfile.open(
+            fileobj=tar_writer, mode="w:", copybufsize=COPY_BUFFER_SIZE
+        ) as tar:
+            if global_conf.file_checksum == FileChecksum.blake3:
+                checksum_header = PAX_HEADER_BLAKE3
+            else:
+                checksum_header = PAX_HEADER_SHA256
+            create_layer(
+                tar,
+                upper,
+                lower_tars,
+                lower_indexes,
+                global_conf.threads,
+                checksum_header,
             )
-            with copied_blob.create() as copiedfile:
-                shutil.copyfileobj(tfile, copiedfile)
-            new_layer_descs.append(copied_blob.descriptor)
 
-        new_diff_ids = [f"sha256:{tar_hash.hexdigest()}"]
+    if global_conf.compression == Compression.gzip:
+        new_diff_ids = [f"sha256:{tar_writer.hash.hexdigest()}"]
+    else:
+        new_diff_ids = [layer_blob.descriptor["digest"]]
 
-    return new_layer_descs, new_diff_ids
+    return [layer_blob.descriptor], new_diff_ids
 
 
 def build_image(global_conf, image):
@@ -204,10 +321,10 @@ def build_image(global_conf, image):
     config["rootfs"] = {"type": "layers", "diff_ids": diff_ids}
     config["history"] = history
     config_blob = Blob(
-        global_conf, media_type="application/vnd.oci.image.config.v1+json", text=True
+        global_conf, media_type="application/vnd.oci.image.config.v1+json"
     )
     with config_blob.create() as configfile:
-        json.dump(config, configfile)
+        dump_json_bytes(config, configfile)
 
     manifest = {"schemaVersion": 2}
     manifest["layers"] = layer_descs
@@ -215,10 +332,10 @@ def build_image(global_conf, image):
     if "annotations" in image:
         manifest["annotations"] = image["annotations"]
     manifest_blob = Blob(
-        global_conf, media_type="application/vnd.oci.image.manifest.v1+json", text=True
+        global_conf, media_type="application/vnd.oci.image.manifest.v1+json"
     )
     with manifest_blob.create() as manifestfile:
-        json.dump(manifest, manifestfile)
+        dump_json_bytes(manifest, manifestfile)
     platform = {"os": image["os"], "architecture": image["architecture"]}
     if "os.version" in image:
         platform["os.version"] = image["os.version"]
@@ -235,11 +352,21 @@ def build_image(global_conf, image):
 
 
 def build_images(global_conf, images, annotations):
-    manifests = []
-
-    for image in images:
-        manifest = build_image(global_conf, image)
-        manifests.append(manifest)
+    if len(images) > 1:
+        # Images are independent of each other and each one is CPU bound on
+        # compression and hashing, so build them in parallel. map() keeps the
+        # manifests in the same order as the images
+        cpus = os.cpu_count() or 1
+        workers = min(len(images), cpus)
+        # Every worker would otherwise start hashing and compression threads
+        # for all the cores, so share the cores out between them
+        worker_conf = dataclasses.replace(global_conf, threads=max(1, cpus // workers))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            manifests = list(
+                pool.map(functools.partial(build_image, worker_conf), images)
+            )
+    else:
+        manifests = [build_image(global_conf, image) for image in images]
 
     index = {"schemaVersion": 2}
     index["manifests"] = manifests
@@ -20,76 +20,376 @@
 
 import errno
 import hashlib
+import importlib
+import io
+import json
+import mmap
 import os
 import stat
 import tarfile
+import tempfile
+import types
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, cast
+
+# Imported by name so that mypy, and the code mypyc compiles, see a module
+# that may be None rather than one that is always there
+blake3: types.ModuleType | None
+try:
+    blake3 = importlib.import_module("blake3")
+except ImportError:
+    blake3 = None
 
 PAX_HEADER_SHA256 = "freedesktopsdk.checksum.sha256"
+# Opt-in replacement for PAX_HEADER_SHA256 on files without a checksum xattr.
+# It is faster to compute, but builders that only dedup on the sha256 header
+# (such as the Rust one) cannot dedup against layers that use it
+PAX_HEADER_BLAKE3 = "freedesktopsdk.checksum.blake3"
 PAX_HEADER_XATTR = "SCHILY.xattr."
-
-
-def xattr_sha256(filename):
+# Files larger than this are hashed in chunks rather than mapped in one go
+MMAP_HASH_LIMIT = 256 * 1024**2
+# TarInfo attributes saved in a tar index, enough for create_layer to compare
+# members and for extractfile() to find their data without a scan
+TAR_INDEX_ATTRS = (
+    "name",
+    "uid",
+    "gid",
+    "mode",
+    "mtime",
+    "size",
+    "linkname",
+    "offset",
+    "offset_data",
+    "pax_headers",
+)
+# Part of the tar index file name, bump it whenever the format (e.g.
+# TAR_INDEX_ATTRS) changes so that indexes from other versions are not read
+TAR_INDEX_VERSION = 1
+
+
+def read_xattrs(filename: str) -> dict[str, bytes]:
+    # One listxattr() plus one getxattr() per attribute that exists, rather
+    # than probing for each attribute we are interested in
     try:
-        checksum = os.getxattr(filename, "user.checksum.sha256", follow_symlinks=False)
+        return {
+            attr: os.getxattr(filename, attr, follow_symlinks=False)
+            for attr in os.listxattr(filename, follow_symlinks=False)
+        }
     except OSError as error:
-        if error.errno == errno.ENODATA:
-            # This is given if the xattr did not exist, we will fallback
-            # to calculating sha256 manually
-            return None
-        raise
+        if error.errno != errno.ENOTSUP:
+            raise
+        return {}
+
+
+def xattr_checksum(xattrs: dict[str, bytes], algo: str) -> str | None:
+    checksum = xattrs.get(f"user.checksum.{algo}")
+    if checksum is None:
+        # We will fallback to calculating the checksum manually
+        return None
     return checksum.decode()
 
 
-def getallxattr(filename):
-    try:
-        for attr in os.listxattr(filename, follow_symlinks=False):
-            value = os.getxattr(filename, attr, follow_symlinks=False)
-            yield attr, value.decode("utf-8", errors="surrogateescape")
-    except OSError as error:
-        if error.errno != errno.ENOTSUP:
-            raise
+def xattr_sha256(xattrs: dict[str, bytes]) -> str | None:
+    return xattr_checksum(xattrs, "sha256")
 
 
-def attr_set(items):
-    return set([(k, v) for k, v in items if k.startswith(PAX_HEADER_XATTR)])
+def xattr_blake3(xattrs: dict[str, bytes]) -> str | None:
+    return xattr_checksum(xattrs, "blake3")
 
 
-def file_sha256(file_handle):
-    sha256 = hashlib.sha256()
-    while chunk := file_handle.read(1024**2):
-        sha256.update(chunk)
-    return sha256.hexdigest()
+def xattr_pax_headers(xattrs: dict[str, bytes]) -> dict[str, str]:
+    return {
+        f"{PAX_HEADER_XATTR}{attr}": value.decode("utf-8", errors="surrogateescape")
+        for attr, value in xattrs.items()
+    }
 
 
-def analyze_lowers(lowers):
-    lower_files = {}
-    for lower in lowers:
-        for lower_member in lower.getmembers():
-            dirname, basename = os.path.split(lower_member.name)
+def attr_set(items: Iterable[tuple[str, str]]) -> set[tuple[str, str]]:
+    return set([(k, v) for k, v in items if k.startswith(PAX_HEADER_XATTR)])
+
+
+def file_digest(file_handle: io.BufferedIOBase, digest: Callable[..., Any]) -> Any:
+    # Mapping the file lets the whole of it be hashed in a single call without
+    # copying it through Python buffers first
+    try:
+        fileno = file_handle.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        fileno = None
+    if fileno is not None:
+        size = os.fstat(fileno).st_size
+        if 0 < size <= MMAP_HASH_LIMIT:
+            try:
+                mapped = mmap.mmap(fileno, size, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                # Not every filesystem supports mapping (e.g. some FUSE ones),
+                # read the file instead
+                pass
+            else:
+                with mapped:
+                    return digest(mapped)
+    return hashlib.file_digest(file_handle, digest)
+
+
+def file_sha256(file_handle: io.BufferedIOBase) -> str:
+    return file_digest(file_handle, hashlib.sha256).hexdigest()
+
+
+def file_blake3(file_handle: io.BufferedIOBase) -> str:
+    # Only used once usable_headers() or create_layer found the module
+    assert blake3 is not None
+    return file_digest(file_handle, blake3.blake3).hexdigest()
+
+
+def file_checksum(file_handle: io.BufferedIOBase, header: str) -> str:
+    if header == PAX_HEADER_BLAKE3:
+        return file_blake3(file_handle)
+    return file_sha256(file_handle)
+
+
+def usable_headers() -> list[str]:
+    # Checksums that can be computed here, fastest first
+    if blake3 is not None:
+        return [PAX_HEADER_BLAKE3, PAX_HEADER_SHA256]
+    return [PAX_HEADER_SHA256]
+
+
+def file_checksums(
+    path: str, xattrs: dict[str, bytes], checksum_header: str
+) -> dict[str, str]:
+    # Build systems that already know the checksum of a file can store it in
+    # the user.checksum.sha256 or user.checksum.blake3 xattr (e.g. with
+    # setfattr), then unchanged files never have to be read to dedup them
+    checksums = {}
+    sha256 = xattr_sha256(xattrs)
+    if sha256:
+        checksums[PAX_HEADER_SHA256] = sha256
+    blake3_checksum = xattr_blake3(xattrs)
+    if blake3_checksum:
+        checksums[PAX_HEADER_BLAKE3] = blake3_checksum
+    if not checksums:
+        with open(path, "rb") as file:
+            checksums[checksum_header] = file_checksum(file, checksum_header)
+    return checksums
+
+
+def file_info(
+    path: str, checksum_header: str, xattrs: dict[str, bytes] | None = None
+) -> tuple[dict[str, bytes], dict[str, str]]:
+    if xattrs is None:
+        xattrs = read_xattrs(path)
+    return xattrs, file_checksums(path, xattrs, checksum_header)
+
+
+def same_checksum(
+    path: str,
+    checksums: dict[str, str],
+    lower_member: tarfile.TarInfo,
+    lower_checksums: dict[str, str],
+) -> bool:
+    lower_headers = lower_member.pax_headers
+    # When both sides carry the same kind of checksum this is just a string
+    # compare, nothing needs to be read or hashed
+    for header in PAX_HEADER_BLAKE3, PAX_HEADER_SHA256:
+        if header in checksums and header in lower_headers:
+            return checksums[header] == lower_headers[header]
+
+    headers = usable_headers()
+    # The lower layer used a different checksum, so hash the file again
+    # the same way
+    for header in headers:
+        if header in lower_headers:
+            with open(path, "rb") as file:
+                return file_checksum(file, header) == lower_headers[header]
+    # The lower layer was not built by us, or with a checksum we cannot
+    # compute. Compare with its copy of the file, hashed up front by
+    # hash_lower_members()
+    for header in headers:
+        if header in checksums and header in lower_checksums:
+            return checksums[header] == lower_checksums[header]
+    return False
+
+
+def lower_hash_header(xattrs: dict[str, bytes], checksum_header: str) -> str | None:
+    # The header same_checksum() compares on for a lower member without a
+    # usable checksum: the first usable one the upper file's checksums will have
+    headers = []
+    if xattr_sha256(xattrs):
+        headers.append(PAX_HEADER_SHA256)
+    if xattr_blake3(xattrs):
+        headers.append(PAX_HEADER_BLAKE3)
+    if not headers:
+        headers.append(checksum_header)
+    for header in usable_headers():
+        if header in headers:
+            return header
+    return None
+
+
+def hash_lower_members(
+    upper: str,
+    lower_files: dict[str, tarfile.TarFile],
+    lower_members: dict[tarfile.TarFile, dict[str, tarfile.TarInfo]],
+    checksum_header: str,
+    epoch: str | None,
+) -> tuple[dict[str, dict[str, str]], dict[str, dict[str, bytes]]]:
+    # Lowers not built by us have no checksums, and ones built with blake3
+    # cannot be checked without the blake3 module. So the members that may be
+    # unchanged in upper have to be hashed. Seeking backwards in a compressed
+    # tar decompresses it again from the start, so rather than reading them
+    # in the order upper is walked, read them in one pass in archive order
+    wanted: dict[tarfile.TarFile, list[tuple[tarfile.TarInfo, str]]] = {}
+    # The xattrs read here are handed back so create_layer does not read
+    # them again
+    upper_xattrs: dict[str, dict[str, bytes]] = {}
+    for name, lower in lower_files.items():
+        member = lower_members[lower][name]
+        if not member.isreg() or any(
+            header in member.pax_headers for header in usable_headers()
+        ):
+            continue
+        path = f"{upper}/{name}"
+        try:
+            statres = os.lstat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        # Only hash members that create_layer would find otherwise unchanged
+        if epoch is not None:
+            mtime = float(int(epoch))
+        else:
+            mtime = statres.st_mtime
+        if (
+            not stat.S_ISREG(statres.st_mode)
+            or statres.st_uid != member.uid
+            or statres.st_gid != member.gid
+            or stat.S_IMODE(statres.st_mode) != member.mode
+            or mtime != member.mtime
+            or statres.st_size != member.size
+        ):
+            continue
+        xattrs = upper_xattrs[name] = read_xattrs(path)
+        if attr_set(xattr_pax_headers(xattrs).items()) != attr_set(
+            member.pax_headers.items()
+        ):
+            continue
+        header = lower_hash_header(xattrs, checksum_header)
+        if header is not None:
+            wanted.setdefault(lower, []).append((member, header))
+
+    lower_checksums: dict[str, dict[str, str]] = {}
+    for lower, members in wanted.items():
+        members.sort(key=lambda item: item[0].offset_data)
+        for member, header in members:
+            # Regular members always have a file object
+            member_file = cast(io.BufferedReader, lower.extractfile(member))
+            with member_file:
+                lower_checksums[member.name] = {
+                    header: file_checksum(member_file, header)
+                }
+    return lower_checksums, upper_xattrs
+
+
+def write_tar_index(index_file: str, members: list[tarfile.TarInfo]) -> None:
+    entries = []
+    for member in members:
+        entry = {attr: getattr(member, attr) for attr in TAR_INDEX_ATTRS}
+        entry["type"] = member.type.decode("latin-1")
+        if member.sparse is not None:
+            entry["sparse"] = member.sparse
+        entries.append(entry)
+    index_dir = os.path.dirname(index_file)
+    os.makedirs(index_dir, exist_ok=True)
+    # Write it atomically so concurrent builds never see a partial index
+    with tempfile.NamedTemporaryFile(
+        mode="w", encoding="utf-8", dir=index_dir, delete=False
+    ) as file:
+        try:
+            json.dump(entries, file)
+        except:  # noqa: E722
+            os.unlink(file.name)
+            raise
+    os.rename(file.name, index_file)
+
+
+def read_tar_index(index_file: str) -> list[tarfile.TarInfo]:
+    with open(index_file, "rb") as file:
+        entries = json.loads(file.read())
+    members = []
+    for entry in entries:
+        member = tarfile.TarInfo()
+        for attr in TAR_INDEX_ATTRS:
+            setattr(member, attr, entry[attr])
+        member.type = entry["type"].encode("latin-1")
+        if "sparse" in entry:
+            member.sparse = [  # type: ignore[assignment]
+                tuple(section) for section in entry["sparse"]
+            ]
+        members.append(member)
+    return members
+
+
+def get_lower_members(
+    lower: tarfile.TarFile, index_file: str | None
+) -> list[tarfile.TarInfo]:
+    # Listing a tar means reading (and for gzip, decompressing) all of it.
+    # Lowers are content addressed blobs, so their member list can be cached
+    if index_file is not None:
+        try:
+            return read_tar_index(index_file)
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            # A missing, damaged or otherwise unreadable index is only a cache
+            # miss, scan the tar and write it again
+            pass
+    members = lower.getmembers()
+    if index_file is not None:
+        write_tar_index(index_file, members)
+    return members
+
+
+def analyze_lowers(
+    lowers: list[tarfile.TarFile], lower_indexes: list[str | None] | None = None
+) -> tuple[
+    dict[str, tarfile.TarFile],
+    dict[str, list[str]],
+    dict[tarfile.TarFile, dict[str, tarfile.TarInfo]],
+]:
+    if lower_indexes is None:
+        lower_indexes = [None] * len(lowers)
+    lower_files: dict[str, tarfile.TarFile] = {}
+    lower_members: dict[tarfile.TarFile, dict[str, tarfile.TarInfo]] = {}
+    for lower, index_file in zip(lowers, lower_indexes):
+        # getmember() does a linear scan of the archive, so index the members
+        # by name once. Later entries with the same name win, like getmember()
+        members: dict[str, tarfile.TarInfo] = {}
+        lower_members[lower] = members
+        for lower_member in get_lower_members(lower, index_file):
+            name = lower_member.name
+            members[name] = lower_member
+            # Tar member names always use "/" so avoid the os.path overhead
+            dirname, _, basename = name.rpartition("/")
             if basename == ".wh..wh..opq":
                 prefix = dirname + "/"
-                to_delete = []
-                for k in lower_files:
-                    if k.startswith(prefix):
-                        to_delete.append(k)
-                for k in to_delete:
-                    del lower_files[k]
+                lower_files = {
+                    k: v for k, v in lower_files.items() if not k.startswith(prefix)
+                }
             elif basename.startswith(".wh."):
-                del lower_files[os.path.join(dirname, basename[4:])]
+                # A whiteout can refer to a file we never saw, e.g. one removed
+                # by an earlier opaque whiteout, so do not fail on it
+                if dirname:
+                    lower_files.pop(f"{dirname}/{basename[4:]}", None)
+                else:
+                    lower_files.pop(basename[4:], None)
             else:
-                lower_files[lower_member.name] = lower
+                lower_files[name] = lower
 
-    lower_dir_contents = {}
+    lower_dir_contents: dict[str, list[str]] = {}
     for file in lower_files:
-        dirname, basename = os.path.split(file)
-        if dirname not in lower_dir_contents:
-            lower_dir_contents[dirname] = []
-        lower_dir_contents[dirname].append(basename)
+        dirname, _, basename = file.rpartition("/")
+        lower_dir_contents.setdefault(dirname, []).append(basename)
 
-    return lower_files, lower_dir_contents
+    return lower_files, lower_dir_contents, lower_members
 
 
-def dummy_tarinfo(name, original):
+def dummy_tarinfo(name: str, original: tarfile.TarInfo) -> tarfile.TarInfo:
     tinfo = tarfile.TarInfo(name=name)
     tinfo.uid = original.uid
     tinfo.gid = original.gid
@@ -100,101 +400,138 @@ def dummy_tarinfo(name, original):
     return tinfo
 
 
-def create_layer(output, upper, lowers):
-    lower_files, lower_dir_contents = analyze_lowers(lowers)
+def create_layer(
+    output: tarfile.TarFile,
+    upper: str,
+    lowers: list[tarfile.TarFile],
+    lower_indexes: list[str | None] | None = None,
+    threads: int | None = None,
+    checksum_header: str = PAX_HEADER_SHA256,
+) -> None:
+    if checksum_header == PAX_HEADER_BLAKE3 and blake3 is None:
+        raise RuntimeError("The blake3 file checksum needs the blake3 module")
 
-    epoch = os.environ.get("SOURCE_DATE_EPOCH")
+    lower_files, lower_dir_contents, lower_members = analyze_lowers(
+        lowers, lower_indexes
+    )
 
-    stack = [upper]
-    while stack:
-        root = stack.pop(-1)
-
-        root_rel = os.path.relpath(root, upper)
+    epoch = os.environ.get("SOURCE_DATE_EPOCH")
 
-        dir_tinfo = output.gettarinfo(name=root, arcname=root_rel)
-        if epoch:
-            dir_tinfo.mtime = int(epoch)
-        output.addfile(dir_tinfo)
+    lower_checksums, upper_xattrs = hash_lower_members(
+        upper, lower_files, lower_members, checksum_header, epoch
+    )
+
+    # Checksumming files is the most expensive part of the layer, and hashlib
+    # releases the GIL, so hash each directory's files on a pool of threads
+    with ThreadPoolExecutor(max_workers=threads or os.cpu_count()) as pool:
+        # Paths are joined by hand in this loop since it runs for every file in
+        # the layer. Each directory is kept with its path relative to upper
+        stack = [(upper, ".")]
+        while stack:
+            root, root_rel = stack.pop(-1)
+
+            dir_tinfo = output.gettarinfo(name=root, arcname=root_rel)
+            if epoch:
+                dir_tinfo.mtime = int(epoch)
+            output.addfile(dir_tinfo)
+
+            files = []
+            dirs = []
+            file_info_futures = {}
+            with os.scandir(root) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.name)
+                    else:
+                        files.append(entry.name)
+                        if entry.is_file(follow_symlinks=False):
+                            file_info_futures[entry.name] = pool.submit(
+                                file_info,
+                                entry.path,
+                                checksum_header,
+                                upper_xattrs.get(f"{root_rel}/{entry.name}"),
+                            )
 
-        files = []
-        dirs = []
-        with os.scandir(root) as entries:
-            for entry in entries:
-                if entry.is_dir(follow_symlinks=False):
-                    dirs.append(entry.name)
+            for directory in reversed(sorted(dirs)):
+                if root_rel == ".":
+                    stack.append((f"{root}/{directory}", directory))
                 else:
-                    files.append(entry.name)
-
-        for directory in reversed(sorted(dirs)):
-            stack.append(os.path.join(root, directory))
-
-        for old_file in lower_dir_contents.get(root_rel, []):
-            if old_file not in files and old_file not in dirs:
-                full_path = os.path.join(root_rel, old_file)
-                old_tar = lower_files[full_path]
-                old_info = old_tar.getmember(full_path)
-                new_name = os.path.join(root_rel, f".wh.{old_file}")
-                wh_tinfo = dummy_tarinfo(new_name, old_info)
-                output.addfile(wh_tinfo)
-
-        for file in sorted(files):
-            path = os.path.join(root, file)
-            rel = os.path.join(root_rel, file)
-            tinfo = output.gettarinfo(name=path, arcname=rel)
-            tinfo.mode = stat.S_IMODE(tinfo.mode)
-            if tinfo.type == tarfile.REGTYPE:
-                checksum = xattr_sha256(path)
-                if not checksum:
-                    with open(path, "rb") as file:
-                        checksum = file_sha256(file)
-                tinfo.pax_headers[PAX_HEADER_SHA256] = checksum
-                for attr, value in getallxattr(path):
-                    tinfo.pax_headers[f"{PAX_HEADER_XATTR}{attr}"] = value
-
-            if epoch is not None:
-                tinfo.mtime = int(epoch)
-
-            if rel in lower_files:
-                tar_file = lower_files[rel]
-                lower_found = tar_file.getmember(rel)
-                same_info = True
-
-                for attr in "type", "uid", "gid", "mode", "mtime", "size":
-                    if getattr(tinfo, attr) != getattr(lower_found, attr):
-                        same_info = False
-                        break
-
-                if same_info:
-                    same_info = attr_set(tinfo.pax_headers.items()) == attr_set(
-                        lower_found.pax_headers.items()
-                    )
-
-                if same_info:
-                    if tinfo.type == tarfile.REGTYPE:
-                        other_checksum = lower_found.pax_headers.get(PAX_HEADER_SHA256)
-                        if not other_checksum:
-                            other_checksum = file_sha256(
-                                tar_file.extractfile(other_checksum)
-                            )
-                        if checksum == other_checksum:
-                            # We already added file to inode cache so we clean it up
-                            output.inodes = {
-                                inode: arcname
-                                for inode, arcname in output.inodes.items()
-                                if arcname != tinfo.name
-                            }
-                            continue
-                    elif tinfo.type == tarfile.LNKTYPE:
-                        # File is already in tarfile so we don't need to test anything
-                        pass
-                    elif tinfo.type == tarfile.SYMTYPE:
-                        if tinfo.linkname == os.readlink(path):
-                            continue
+                    stack.append((f"{root}/{directory}", f"{root_rel}/{directory}"))
+
+            for old_file in lower_dir_contents.get(root_rel, []):
+                if old_file not in files and old_file not in dirs:
+                    full_path = f"{root_rel}/{old_file}"
+                    old_tar = lower_files[full_path]
+                    old_info = lower_members[old_tar][full_path]
+                    new_name = f"{root_rel}/.wh.{old_file}"
+                    wh_tinfo = dummy_tarinfo(new_name, old_info)
+                    output.addfile(wh_tinfo)
+
+            for file in sorted(files):
+                path = f"{root}/{file}"
+                rel = f"{root_rel}/{file}"
+                tinfo = output.gettarinfo(name=path, arcname=rel)
+                tinfo.mode = stat.S_IMODE(tinfo.mode)
+                if tinfo.type == tarfile.REGTYPE:
+                    if file in file_info_futures:
+                        xattrs, checksums = file_info_futures[file].result()
                     else:
-                        raise RuntimeError(f"{path} unexpected type {tinfo.type}")
+                        xattrs, checksums = file_info(
+                            path, checksum_header, upper_xattrs.get(rel)
+                        )
+                    # gettarinfo() starts with no pax headers, so build them
+                    # up in a plain dict and set them once
+                    pax_headers = dict(checksums)
+                    pax_headers.update(xattr_pax_headers(xattrs))
+                    tinfo.pax_headers = pax_headers
+
+                if epoch is not None:
+                    tinfo.mtime = int(epoch)
+
+                if rel in lower_files:
+                    lower_found = lower_members[lower_files[rel]][rel]
+                    # Spelled out rather than looping over getattr() so each
+                    # compare is a plain typed attribute access
+                    same_info = (
+                        tinfo.type == lower_found.type
+                        and tinfo.uid == lower_found.uid
+                        and tinfo.gid == lower_found.gid
+                        and tinfo.mode == lower_found.mode
+                        and tinfo.mtime == lower_found.mtime
+                        and tinfo.size == lower_found.size
+                        and attr_set(tinfo.pax_headers.items())
+                        == attr_set(lower_found.pax_headers.items())
+                    )
 
-            if tinfo.type == tarfile.REGTYPE:
-                with open(path, "rb") as file_stream:
-                    output.addfile(tinfo, file_stream)
-            else:
-                output.addfile(tinfo)
+                    if same_info:
+                        if tinfo.type == tarfile.REGTYPE:
+                            if same_checksum(
+                                path,
+                                checksums,
+                                lower_found,
+                                lower_checksums.get(rel, {}),
+                            ):
+                                # We already added file to inode cache so we clean
+                                # it up. Only drop our own entry, rebuilding the
+                                # whole cache for every skipped file is quadratic
+                                statres = os.lstat(path)
+                                inode = (statres.st_ino, statres.st_dev)
+                                inodes = output.inodes  # type: ignore[attr-defined]
+                                if inodes.get(inode) == tinfo.name:
+                                    del inodes[inode]
+                                continue
+                        elif tinfo.type == tarfile.LNKTYPE:
+                            # File is already in tarfile so we don't need to test
+                            # anything
+                            pass
+                        elif tinfo.type == tarfile.SYMTYPE:
+                            if tinfo.linkname == os.readlink(path):
+                                continue
+                        else:
+                            raise RuntimeError(f"{path} unexpected type {tinfo.type!r}")
+
+                if tinfo.type == tarfile.REGTYPE:
+                    with open(path, "rb") as file_stream:
+                        output.addfile(tinfo, file_stream)
+                else:
+                    output.addfile(tinfo)
@@ -1,3 +1,14 @@
+import os
+
 from setuptools import setup
 
-setup()
+ext_modules = []
+# The per-file loop of create_layer is pure Python overhead on large layers.
+# Set OCI_BUILDER_MYPYC=1 to compile it with mypyc (needs mypy at build time),
+# otherwise the plain module is used
+if os.environ.get("OCI_BUILDER_MYPYC") == "1":
+    from mypyc.build import mypycify
+
+    ext_modules = mypycify(["oci_builder/layer_builder.py"])
+
+setup(ext_modules=ext_modules)